@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 import sys
 import os
+import re
+import io
 import json
-import pandas as pd
+import base64
+import functools
 from datetime import datetime
 from pathlib import Path
-import tempfile
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from uuid import uuid4
+from cachetools import TTLCache
 from mcp.server.fastmcp import FastMCP
 from fubon_neo.sdk import FubonSDK
 from typing import Dict
@@ -20,6 +25,13 @@ BASE_DATA_DIR = Path(os.getenv('FUBON_DATA_DIR', default_data_dir))
 BASE_DATA_DIR.mkdir(parents=True, exist_ok=True)
 print(f"使用數據目錄: {BASE_DATA_DIR}", file=sys.stderr)
 
+# 偵錯輸出預設關閉，避免熱路徑上對大型API回應做str格式化
+_DEBUG = os.getenv('FUBON_DEBUG') == '1'
+
+def _log(*args):
+    if _DEBUG:
+        print(*args, file=sys.stderr)
+
 # 從環境變量獲取認證信息
 username = os.getenv('FUBON_USERNAME')
 password = os.getenv('FUBON_PASSWORD')
@@ -37,59 +49,184 @@ accounts = sdk.login(username, password, pfx_path)
 sdk.init_realtime()
 reststock = sdk.marketdata.rest_client.stock
 
+def _install_pooled_session(client):
+    """若SDK底層使用requests，換上連線池session讓分段請求重用TLS連線"""
+    try:
+        import requests
+        from requests.adapters import HTTPAdapter, Retry
+    except ImportError:
+        return
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8,
+                          max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount('https://', adapter)
+
+    # 依SDK版本不同，session可能掛在rest_client本身或其內部client上
+    for target in (client, getattr(client, 'client', None)):
+        if target is None:
+            continue
+        for attr in ('session', '_session'):
+            if isinstance(getattr(target, attr, None), requests.Session):
+                setattr(target, attr, session)
+                return
+
+_install_pooled_session(sdk.marketdata.rest_client)
+
+
+# 各欄位的預定dtype，寫入前一次性轉換，避免完整的型別推斷
+_COLUMN_DTYPES = {
+    'open': 'float32',
+    'high': 'float32',
+    'low': 'float32',
+    'close': 'float32',
+    'volume': 'int64',
+    'vol_value': 'float64',
+    'price_change': 'float32',
+    'change_ratio': 'float32',
+}
+
+def _downcast_numeric(df):
+    """將數值欄位降轉為較小的dtype，減少記憶體用量與後續運算的頻寬"""
+    import pandas as pd
+
+    for col in ('open', 'high', 'low', 'close', 'vol_value', 'price_change', 'change_ratio'):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    if 'volume' in df.columns:
+        df['volume'] = pd.to_numeric(df['volume'], downcast='integer')
+    return df
+
+@functools.lru_cache(maxsize=256)
+def _load_cached(stock_code, mtime_ns):
+    """解析Parquet檔案並快取結果，檔案mtime改變時自動失效"""
+    import pyarrow.parquet as pq
+
+    file_path = BASE_DATA_DIR / f"{stock_code}.parquet"
+    table = pq.read_table(file_path, use_threads=True)
+    df = _downcast_numeric(table.to_pandas())
+    return df.sort_values(by='date', ascending=False)
+
+@functools.lru_cache(maxsize=64)
+def _slice_cached(stock_code, from_date, to_date, mtime_ns):
+    """快取指定日期範圍的切片結果"""
+    import numpy as np
+
+    df = _load_cached(stock_code, mtime_ns)
+    # 日期欄已排序(降冪)，以searchsorted做O(log N)切片取代全欄布林比較
+    dates = df['date'].to_numpy()[::-1]  # 升冪視圖
+    lo = dates.searchsorted(np.datetime64(from_date), side='left')
+    hi = dates.searchsorted(np.datetime64(to_date), side='right')
+    n = len(dates)
+    return df.iloc[n - hi:n - lo]
+
+# API回應的短期快取，相同範圍60秒內不重發網路請求
+_api_cache = TTLCache(maxsize=512, ttl=60)
+_api_cache_lock = threading.Lock()
+
+def _fetch_candles(symbol, from_date, to_date):
+    """呼叫歷史K線API，相同(symbol, from, to)在TTL內直接回傳快取回應"""
+    key = (symbol, from_date, to_date)
+    with _api_cache_lock:
+        if key in _api_cache:
+            return _api_cache[key]
+
+    response = reststock.historical.candles(**{"symbol": symbol, "from": from_date, "to": to_date})
+    with _api_cache_lock:
+        _api_cache[key] = response
+    return response
+
+def _to_records(df):
+    """以Arrow的C實作將DataFrame轉成列紀錄，比to_dict('records')快數倍"""
+    import pyarrow as pa
 
-def read_local_stock_data(stock_code):
-    """讀取本地股票CSV數據"""
+    return pa.Table.from_pandas(df, preserve_index=False).to_pylist()
+
+def _serialize_frame(df, fmt):
+    """依format序列化DataFrame；arrow格式回傳base64編碼的Feather位元組"""
+    if fmt == 'arrow':
+        from pyarrow import feather
+
+        sink = io.BytesIO()
+        feather.write_feather(df, sink, compression='zstd')
+        return base64.b64encode(sink.getvalue()).decode()
+    return _to_records(df)
+
+def _add_derived_columns(df):
+    """以numpy陣列計算衍生欄位，避免Series對齊的額外配置"""
+    import numpy as np
+
+    close = df['close'].to_numpy()
+    open_ = df['open'].to_numpy()
+    volume = df['volume'].to_numpy()
+    safe_open = np.where(open_ != 0, open_, 1)
+    df['vol_value'] = close * volume  # 成交值
+    df['price_change'] = close - open_  # 漲跌
+    df['change_ratio'] = np.where(open_ != 0, (close - open_) / safe_open * 100, 0.0)  # 漲跌幅
+    return df
+
+def read_local_stock_data(stock_code, from_date=None, to_date=None):
+    """讀取本地股票Parquet數據，可只取指定日期範圍的切片"""
     try:
-        file_path = BASE_DATA_DIR / f"{stock_code}.csv"
+        file_path = BASE_DATA_DIR / f"{stock_code}.parquet"
         if not file_path.exists():
             return None
-        
-        df = pd.read_csv(file_path)
-        df['date'] = pd.to_datetime(df['date'])
-        df = df.sort_values(by='date', ascending=False)
-        return df
+
+        mtime_ns = file_path.stat().st_mtime_ns
+        if from_date is not None and to_date is not None:
+            return _slice_cached(stock_code, from_date, to_date, mtime_ns).copy(deep=False)
+        return _load_cached(stock_code, mtime_ns).copy(deep=False)
     except Exception as e:
-        print(f"讀取CSV檔案時發生錯誤: {str(e)}", file=sys.stderr)
+        print(f"讀取Parquet檔案時發生錯誤: {str(e)}", file=sys.stderr)
         return None
 
-def save_to_local_csv(symbol: str, new_data: list):
-    """將新數據保存到本地CSV，避免重複數據"""
+def save_to_local_csv(symbol: str, new_data: list, existing_df=None):
+    """將新數據保存到本地Parquet，避免重複數據；可傳入已載入的現有數據省去重讀"""
+    import numpy as np
+    import pandas as pd
+
     try:
-        file_path = BASE_DATA_DIR / f"{symbol}.csv"
+        file_path = BASE_DATA_DIR / f"{symbol}.parquet"
+
+        if existing_df is None and file_path.exists():
+            existing_df = pd.read_parquet(file_path)
+
+        if existing_df is not None:
+            # 以Python set過濾重複日期，省去對整個現有frame做hash去重
+            existing_dates = set(existing_df['date'].to_numpy().astype('datetime64[D]'))
+            new_data = [row for row in new_data if np.datetime64(row['date'], 'D') not in existing_dates]
+
+            if not new_data:
+                _log(f"{symbol} 無新增資料，檔案保持不變")
+                return
+
         new_df = pd.DataFrame(new_data)
         new_df['date'] = pd.to_datetime(new_df['date'])
-        
-        # 創建臨時檔案
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.csv') as temp_file:
-            temp_path = Path(temp_file.name)
-            
-            try:
-                if file_path.exists():
-                    # 讀取現有數據
-                    existing_df = pd.read_csv(file_path)
-                    existing_df['date'] = pd.to_datetime(existing_df['date'])
-                    
-                    # 合併數據並刪除重複項
-                    combined_df = pd.concat([existing_df, new_df])
-                    combined_df = combined_df.drop_duplicates(subset=['date'], keep='last')
-                    combined_df = combined_df.sort_values(by='date', ascending=False)
-                else:
-                    combined_df = new_df.sort_values(by='date', ascending=False)
-                
-                # 將合併後的數據寫入臨時檔案
-                combined_df.to_csv(temp_path, index=False)
-                
-                # 原子性地替換原檔案
-                shutil.move(str(temp_path), str(file_path))
-                print(f"成功保存數據到 {file_path}", file=sys.stderr)
-                
-            except Exception as e:
-                # 確保清理臨時檔案
-                if temp_path.exists():
-                    temp_path.unlink()
-                raise e
-                
+        new_df = new_df.astype({c: t for c, t in _COLUMN_DTYPES.items() if c in new_df.columns})
+
+        if existing_df is not None:
+            combined_df = pd.concat([existing_df, new_df])
+        else:
+            combined_df = new_df
+        combined_df = combined_df.sort_values(by='date', ascending=False)
+
+        # 臨時檔案放在同一目錄，os.replace才會是單一rename的原子操作
+        temp_path = file_path.with_suffix(file_path.suffix + '.tmp.' + uuid4().hex)
+
+        try:
+            # 將合併後的數據寫入臨時檔案
+            combined_df.to_parquet(temp_path, engine='pyarrow', compression='zstd', compression_level=3, index=False)
+
+            # 原子性地替換原檔案
+            os.replace(temp_path, file_path)
+            _log(f"成功保存數據到 {file_path}")
+
+        except Exception as e:
+            # 確保清理臨時檔案
+            if temp_path.exists():
+                temp_path.unlink()
+            raise e
+
     except Exception as e:
         print(f"保存CSV檔案時發生錯誤: {str(e)}", file=sys.stderr)
 
@@ -117,11 +254,29 @@ def get_historical_data(symbol):
             'message': f'獲取數據時發生錯誤: {str(e)}'
         }
 
+# 預先編譯日期格式的正則，驗證時不需重新解析
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
 class HistoricalCandlesArgs(BaseModel):
     symbol: str
     from_date: str
     to_date: str
-    
+    format: str = 'json'
+
+    @field_validator('from_date', 'to_date')
+    @classmethod
+    def _check_date_format(cls, value):
+        if not _DATE_RE.match(value):
+            raise ValueError('日期格式必須為 YYYY-MM-DD')
+        return value
+
+    @field_validator('format')
+    @classmethod
+    def _check_format(cls, value):
+        if value not in ('json', 'arrow'):
+            raise ValueError("format 必須為 'json' 或 'arrow'")
+        return value
+
 @mcp.tool()
 def historical_candles(args: Dict) -> dict:
     """
@@ -131,125 +286,116 @@ def historical_candles(args: Dict) -> dict:
         symbol (str): 股票代碼，必須為文字格式，例如: '2330'、'00878'
         from_date (str): 開始日期，格式: YYYY-MM-DD
         to_date (str): 結束日期，格式: YYYY-MM-DD
+        format (str): 回傳格式，'json'(預設)為列紀錄，'arrow'為base64編碼的Feather位元組，適合大量資料
     """
+    import pandas as pd
+
     try:
         # 使用 HistoricalCandlesArgs 進行驗證
-        validated_args = HistoricalCandlesArgs(**args) 
+        validated_args = HistoricalCandlesArgs.model_validate(args)
         # 從驗證後的物件取得參數
         symbol = validated_args.symbol
         from_date = validated_args.from_date
         to_date = validated_args.to_date
+        fmt = validated_args.format
 
-        # 先檢查本地數據
+        # 先檢查本地數據，日期範圍直接在讀取端過濾
         local_data = read_local_stock_data(symbol)
-        
+
         if local_data is not None:
-            df = local_data
-            # 過濾指定日期範圍的數據
-            mask = (df['date'] >= from_date) & (df['date'] <= to_date)
-            df = df[mask]
-            
-            if not df.empty:
-                df = df.sort_values(by='date', ascending=False)
+            df = read_local_stock_data(symbol, from_date, to_date)
+
+            # 本地數據完整涵蓋請求範圍時直接回傳，否則改走API補齊
+            if df is not None and not df.empty \
+                    and local_data['date'].min() <= pd.Timestamp(from_date) \
+                    and local_data['date'].max() >= pd.Timestamp(to_date):
                 # 確保所需的計算欄位存在
-                if 'vol_value' not in df.columns:
-                    df['vol_value'] = df['close'] * df['volume']  # 成交值
-                if 'price_change' not in df.columns:
-                    df['price_change'] = df['close'] - df['open']  # 漲跌
-                if 'change_ratio' not in df.columns:
-                    df['change_ratio'] = (df['close'] - df['open']) / df['open'] * 100  # 漲跌幅
-                result_data = df.to_dict('records')
+                if not {'vol_value', 'price_change', 'change_ratio'} <= set(df.columns):
+                    df = _add_derived_columns(df)
+                result_data = _serialize_frame(df, fmt)
                 return {
                     'status': 'success',
+                    'format': fmt,
                     'data': result_data,
                     'message': f'成功從本地數據獲取 {symbol} 從 {from_date} 到 {to_date} 的數據'
                 }
 
-        # 如果本地沒有數據或日期範圍內沒有數據，使用 API
-        # 轉換日期字串為 datetime 物件
+        # 本地沒有數據或只涵蓋部分範圍時，只向API請求缺少的部分
         from_datetime = pd.to_datetime(from_date)
         to_datetime = pd.to_datetime(to_date)
-        
-        # 計算日期差異
-        date_diff = (to_datetime - from_datetime).days
-        
+
+        # 計算本地數據未涵蓋的缺口
+        gap_windows = []
+        if local_data is not None and not local_data.empty:
+            have_min = local_data['date'].min()
+            have_max = local_data['date'].max()
+            if from_datetime < have_min:
+                gap_windows.append((from_datetime, min(have_min - pd.Timedelta(days=1), to_datetime)))
+            if to_datetime > have_max:
+                gap_windows.append((max(have_max + pd.Timedelta(days=1), from_datetime), to_datetime))
+        else:
+            gap_windows.append((from_datetime, to_datetime))
+
+        # 以date_range一次算出每個缺口的分段起點，每段最多涵蓋366天
+        _SEGMENT_SPAN = pd.Timedelta(days=365)
+        segments = [
+            (start.strftime('%Y-%m-%d'), min(start + _SEGMENT_SPAN, gap_to).strftime('%Y-%m-%d'))
+            for gap_from, gap_to in gap_windows
+            for start in pd.date_range(gap_from, gap_to, freq='366D')
+        ]
+
         # 存儲所有分段資料
         all_data = []
-        
-        # 如果日期間隔超過一年，進行分段
-        if date_diff > 365:
-            current_from = from_datetime
-            while current_from < to_datetime:
-                # 計算當前段的結束日期
-                current_to = min(current_from + pd.Timedelta(days=365), to_datetime)
-                
-                # 準備 API 參數
-                params = {
-                    "symbol": symbol,
-                    "from": current_from.strftime('%Y-%m-%d'),
-                    "to": current_to.strftime('%Y-%m-%d')
-                }
-                
+
+        def fetch_segment(segment):
+            seg_from, seg_to = segment
+            _log(f"正在獲取 {symbol} 從 {seg_from} 到 {seg_to} 的數據...")
+            return _fetch_candles(symbol, seg_from, seg_to)
+
+        # 分段請求為網路IO，平行發出；限制worker數以免觸及API速率限制
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(fetch_segment, segment) for segment in segments]
+            for future in as_completed(futures):
                 try:
-                    print(f"正在獲取 {symbol} 從 {params['from']} 到 {params['to']} 的數據...", file=sys.stderr)
-                    response = reststock.historical.candles(**params)
-                    print(f"API 回應內容: {response}", file=sys.stderr)
-                    
+                    response = future.result()
+                    _log(f"API 回應內容: {response}")
+
                     if isinstance(response, dict):
                         if 'data' in response and response['data']:
                             segment_data = response['data']
                             all_data.extend(segment_data)
-                            print(f"成功獲取 {len(segment_data)} 筆資料", file=sys.stderr)
+                            _log(f"成功獲取 {len(segment_data)} 筆資料")
                         else:
-                            print(f"API 回應無資料: {response}", file=sys.stderr)
+                            _log(f"API 回應無資料: {response}")
                     else:
-                        print(f"API 回應格式錯誤: {response}", file=sys.stderr)
+                        _log(f"API 回應格式錯誤: {response}")
                 except Exception as segment_error:
                     print(f"獲取分段資料時發生錯誤: {str(segment_error)}", file=sys.stderr)
-                
-                # 更新下一段的開始日期
-                current_from = current_to + pd.Timedelta(days=1)
-        else:
-            # 如果間隔小於一年，直接取得資料
-            params = {
-                "symbol": symbol,
-                "from": from_date,
-                "to": to_date
-            }
-            
-            try:
-                print(f"正在獲取 {symbol} 從 {params['from']} 到 {params['to']} 的數據...", file=sys.stderr)
-                response = reststock.historical.candles(**params)
-                print(f"API 回應內容: {response}", file=sys.stderr)
-                
-                if isinstance(response, dict):
-                    if 'data' in response and response['data']:
-                        all_data = response['data']
-                        print(f"成功獲取 {len(all_data)} 筆資料", file=sys.stderr)
-                    else:
-                        print(f"API 回應無資料: {response}", file=sys.stderr)
-                else:
-                    print(f"API 回應格式錯誤: {response}", file=sys.stderr)
-            except Exception as api_error:
-                print(f"API 呼叫發生錯誤: {str(api_error)}", file=sys.stderr)
-        
+
         # 處理合併後的資料
         if all_data:
-            df = pd.DataFrame(all_data)
-            df = df.sort_values(by='date', ascending=False)
-            # 添加更多資訊欄位
-            df['vol_value'] = df['close'] * df['volume']  # 成交值
-            df['price_change'] = df['close'] - df['open']  # 漲跌
-            df['change_ratio'] = (df['close'] - df['open']) / df['open'] * 100  # 漲跌幅
-            # 保存 API 數據到本地
-            save_to_local_csv(symbol, all_data)
-            
-            data = df.to_dict('records')
+            # 先保存API補來的數據，再從更新後的本地快取取完整範圍(含原有部分)
+            save_to_local_csv(symbol, all_data, existing_df=local_data)
+            df = read_local_stock_data(symbol, from_date, to_date)
+
+            if df is None or df.empty:
+                df = _downcast_numeric(pd.DataFrame(all_data))
+                df['date'] = pd.to_datetime(df['date'])
+                df = df.sort_values(by='date', ascending=False)
+        else:
+            # API沒有補到新資料，回傳本地已有的部分
+            df = read_local_stock_data(symbol, from_date, to_date)
+
+        if df is not None and not df.empty:
+            if not {'vol_value', 'price_change', 'change_ratio'} <= set(df.columns):
+                df = _add_derived_columns(df)
+            data = _serialize_frame(df, fmt)
         else:
             data = []
-            
+
         return {
             'status': 'success',
+            'format': fmt,
             'data': data,
             'message': f'成功獲取 {symbol} 從 {from_date} 到 {to_date} 的數據'
         }